@@ -18,13 +18,18 @@
 # HQ X
 # HQ XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX
 
+from __future__ import print_function
+
 import sys
+import math
+import inspect
 import optparse
+from collections import OrderedDict
+from operator import attrgetter, itemgetter
 
 import numpy as np
 
-from ase.atoms import Atoms as AseAtoms
-from ase.data import atomic_masses
+from ase.data import atomic_masses, chemical_symbols
 from ase.db import connect
 from ase.db.cli import plural
 from ase.db.core import float_to_time_string, now
@@ -38,10 +43,164 @@ def cut(txt, length):
         return txt
     return txt[:length - 3] + '...'
 
+# escape sequences for characters which cannot appear in a TSV cell
+tsv_escapes = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]
+
+def tsv_line(cells):
+    """
+    Join `cells` into a line of tab-separated values, escaping backslashes,
+    tabs and newlines. Unicode is encoded as UTF-8 on Python 2, where
+    sys.stdout expects byte strings.
+    """
+    fields = []
+    for cell in cells:
+        if cell is None:
+            cell = ''
+        cell = '%s' % cell
+        for char, escape in tsv_escapes:
+            cell = cell.replace(char, escape)
+        fields.append(cell)
+    line = '\t'.join(fields) + '\n'
+    if not isinstance(line, str):
+        line = line.encode('utf-8')
+    return line
+
+def cell_format(value):
+    """
+    Return printf-style format for a numeric table cell, or None if not numeric
+    """
+    if isinstance(value, (int, np.integer)):
+        return '%d'
+    elif isinstance(value, (float, np.floating)):
+        return '%.3f'
+    return None
+
+_formula_cache = {}
+_mass_cache = {}
+
+# caches are emptied when they reach this many entries
+max_cache_size = 4096
+
+def composition_key(numbers):
+    """
+    Hashable key for composition of array of atomic `numbers`, independent
+    of atom order: the number of atoms of each atomic number.
+    """
+    return tuple(np.bincount(numbers).tolist())
+
+def cache_result(cache, key, value):
+    if len(cache) >= max_cache_size:
+        cache.clear()
+    cache[key] = value
+
+def clear_caches():
+    _formula_cache.clear()
+    _mass_cache.clear()
+
+def hill_formula(numbers):
+    """
+    Return chemical formula in Hill order for array of atomic `numbers`,
+    as produced by ase.atoms.Atoms.get_chemical_formula(). Results are
+    cached since many rows usually share the same composition.
+    """
+    counts = composition_key(numbers)
+    try:
+        return _formula_cache[counts]
+    except KeyError:
+        pass
+    count = dict((chemical_symbols[Z], n) for Z, n in enumerate(counts) if n > 0)
+    # C first if present, then H if present, then the rest alphabetically
+    symbols = [sym for sym in ('C', 'H') if sym in count]
+    symbols += sorted(sym for sym in count if sym not in ('C', 'H'))
+    formula = ''.join([sym if count[sym] == 1 else '%s%d' % (sym, count[sym])
+                       for sym in symbols])
+    cache_result(_formula_cache, counts, formula)
+    return formula
+
+def total_mass(numbers):
+    """
+    Return sum of standard atomic masses for array of atomic `numbers`, cached
+    """
+    key = composition_key(numbers)
+    try:
+        return _mass_cache[key]
+    except KeyError:
+        pass
+    mass = atomic_masses[numbers].sum()
+    cache_result(_mass_cache, key, mass)
+    return mass
+
+def needs(*names, **kwargs):
+    """
+    Decorator to mark the row attributes a column function requires.
+    Rows lacking any of them give an empty cell. Attributes which are
+    used only if present can be listed with the `optional` keyword.
+    """
+    def decorate(func):
+        func.needs = names
+        func.reads = names + tuple(kwargs.get('optional', ()))
+        return func
+    return decorate
+
+def row_has(dct, name):
+    """
+    Return True if row `dct` has attribute `name`. Stored attributes are
+    found with a dictionary lookup; only those computed by a property of
+    the row class are evaluated.
+    """
+    if name in dct:
+        return True
+    return (isinstance(getattr(type(dct), name, None), property) and
+            hasattr(dct, name))
+
+# names of SQL columns which differ from the row attribute they hold
+# (the row's charge property is computed from its initial charges)
+sql_column_names = {'user': 'username',
+                    'charge': 'initial_charges'}
+
+def select_columns(con, names):
+    """
+    Return keyword arguments for con.select() which restrict the data read
+    to the row attributes in `names`, or an empty dict if the database
+    backend does not support this or any attribute is not held in a
+    column which can be selected.
+    """
+    try:
+        args = inspect.signature(con.select).parameters
+    except AttributeError:
+        args = inspect.getargspec(con.select).args # Python 2
+    columnnames = list(getattr(con, 'columnnames', []))
+    if 'columns' not in args or 'data' not in columnnames:
+        return {}
+    # only the columns before 'data' can be selected individually
+    available = set(columnnames[:columnnames.index('data')])
+    columns = set(['id'])
+    for name in names:
+        if name == 'data':
+            continue
+        column = sql_column_names.get(name, name)
+        if column not in available:
+            return {}
+        columns.add(column)
+    kwargs = {'columns': sorted(columns)}
+    if 'include_data' in args:
+        kwargs['include_data'] = 'data' in names
+    elif 'data' in names:
+        return {}
+    return kwargs
+
 class Formatter(object):
     """
     Modified version of old ase.db.cli.Formatter class
     """
+
+    # columns which simply return an attribute of the row
+    attribute_columns = {'id': 'id',
+                         'user': 'user',
+                         'calc': 'calculator',
+                         'energy': 'energy',
+                         'charge': 'charge'}
+
     def __init__(self, cols, sort):
         self.sort = sort
         
@@ -61,81 +220,90 @@ class Formatter(object):
                     self.columns.append(col.lstrip('+'))
         
         self.funcs = []
+        self.needs = []
+        self.required = set()
+        self.reads = set(['id'])
         for col in self.columns:
-            f = getattr(self, col, None)
-            if f is None:
-                f = self.keyval_factory(col)
+            if col in self.attribute_columns:
+                attr = self.attribute_columns[col]
+                f = attrgetter(attr)
+                self.needs.append((attr,))
+                self.required.add(attr)
+                self.reads.add(attr)
+            else:
+                f = getattr(self, col, None)
+                if f is None:
+                    f = self.keyval_factory(col)
+                self.needs.append(f.needs)
+                self.required.update(f.needs)
+                self.reads.update(f.reads)
             self.funcs.append(f)
 
-    def id(self, d):
-        return d.id
-    
+    @needs('ctime')
     def age(self, d):
         return float_to_time_string(now() - d.ctime)
 
-    def user(self, d):
-        return d.user
-    
+    @needs('numbers')
     def formula(self, d):
-        return AseAtoms(d.numbers).get_chemical_formula()
-
-    def energy(self, d):
-        return d.energy
+        return hill_formula(d.numbers)
 
+    @needs('pbc', 'cell')
     def size(self, d):
         dims = d.pbc.sum()
         if dims == 0:
             return ''
         if dims == 1:
-            return np.linalg.norm(d.cell[d.pbc][0])
+            a = d.cell[d.pbc][0]
+            return math.sqrt(a.dot(a))
         if dims == 2:
-            return np.linalg.norm(np.cross(*d.cell[d.pbc]))
+            a, b = d.cell[d.pbc]
+            c = np.cross(a, b)
+            return math.sqrt(c.dot(c))
         return abs(np.linalg.det(d.cell))
 
+    @needs('cell')
     def cell(self, d):
-        if np.all(np.diag(np.diag(d.cell)) == d.cell):
-            return cut('diag([%.1f, %.1f, %.1f])' % tuple(np.diag(d.cell)), self.opts.cut)
+        c = d.cell
+        if (c[0,1] == 0 and c[0,2] == 0 and c[1,0] == 0 and
+            c[1,2] == 0 and c[2,0] == 0 and c[2,1] == 0):
+            return cut('diag([%.1f, %.1f, %.1f])' % (c[0,0], c[1,1], c[2,2]), self.opts.cut)
         else:
-            return cut('[[%.1f, %.1f, %.1f], [%.1f, %.1f, %.1f], [%.1f, %.1f, %.1f]]' % tuple(d.cell.flat), self.opts.cut)
+            return cut('[[%.1f, %.1f, %.1f], [%.1f, %.1f, %.1f], [%.1f, %.1f, %.1f]]' % tuple(c.ravel()), self.opts.cut)
 
+    @needs('pbc')
     def pbc(self, d):
         a, b, c = d.pbc
         return '%d%d%d' % tuple(d.pbc)
 
-    def calc(self, d):
-        return d.calculator
-
+    @needs('forces', optional=('constraints',))
     def fmax(self, d):
-        c = d.constraints
-        if c is None:
-            f = d.forces
-        if len(c) > 1:
-            f = d.forces
-        c = c[0]
-        if 'mask' in c:
-            f = d.forces[np.invert(c['mask'])]
-        else:
-            f = d.forces
-        return (f**2).sum(axis=1).max()**0.5
-
+        c = getattr(d, 'constraints', None)
+        f = d.forces
+        if c is not None and len(c) == 1 and 'mask' in c[0]:
+            f = f[np.invert(c[0]['mask'])]
+        f2 = np.einsum('ij,ij->i', f, f)
+        return math.sqrt(f2.max())
+
+    @needs('keywords')
     def keywords(self, d):
         return cut(','.join(d.keywords), self.opts.cut)
 
+    @needs('key_value_pairs')
     def keyvals(self, d):
         return cut(','.join(['%s=%s' % (key, cut(str(value), 8))
                              for key, value in d.key_value_pairs.items()]), 40)
 
+    @needs('data')
     def data(self, d):
         return cut(','.join(d.data.keys()), self.opts.cut)
 
-    def charge(self, d):
-        return d.charge
-
+    @needs('numbers', optional=('masses',))
     def mass(self, d):
         if 'masses' in d:
             return d.masses.sum()
-        return atomic_masses[d.numbers].sum()
+        return total_mass(d.numbers)
 
+    @needs('constraints')
     def fixed(self, d):
         c = d.constraints
         if c is None:
@@ -147,94 +315,131 @@ class Formatter(object):
             return sum(c['mask'])
         return len(c['indices'])
 
+    @needs('stress')
     def smax(self, d):
-        return (d.stress**2).max()**0.5
+        s = d.stress
+        return math.sqrt(float((s*s).max()))
 
+    @needs('magmom')
     def magmom(self, d):
         return d.magmom or ''
 
     def keyval_factory(self, key):
+        @needs('key_value_pairs')
         def keyval_func(d):
             value = d.key_value_pairs.get(key, '(none)')
             return str(value)
         return keyval_func
 
-    def format(self, dcts, opts):
+    def begin(self, opts):
+        """
+        Start a new table. Rows are then added with format_row() and
+        the table is printed by end().
+        """
         self.opts = opts
         columns = self.columns
         if opts.uniq:
             columns += ['repeat']
         if opts.wiki_table:
             columns = ['*%s*' % col for col in columns]
-        table = [columns]
-        widths = [0 for col in columns]
-        signs = [1 for col in columns]  # left or right adjust
-        ids = []
-        fd = sys.stdout
-        for dct in dcts:
-            row = []
-            for i, f in enumerate(self.funcs):
-                try:
-                    s = f(dct)
-                except AttributeError:
-                    s = ''
+        self.table = [columns]
+        self.signs = [1 for col in columns]  # left or right adjust
+        self.types = [None for col in columns] # type of last value seen in column
+        self.fmts = [None for col in columns]  # cell format for that type
+        self.ids = []
+
+    def cells(self, dct):
+        """
+        Return list of formatted cells for a single row
+        """
+        signs, types, fmts = self.signs, self.types, self.fmts
+        funcs, needs = self.funcs, self.needs
+        # required attributes are checked once per row, not once per cell
+        missing = set([name for name in self.required if not row_has(dct, name)])
+        row = []
+        append = row.append
+        for i, f in enumerate(funcs):
+            if missing and not missing.isdisjoint(needs[i]):
+                s = ''
+            else:
+                s = f(dct)
+                if type(s) is not types[i]:
+                    types[i] = type(s)
+                    fmts[i] = cell_format(s)
+                if fmts[i] is None:
+                    signs[i] = -1
                 else:
-                    if isinstance(s, int):
-                        s = '%d' % s
-                    elif isinstance(s, float):
-                        s = '%.3f' % s
-                    else:
-                        signs[i] = -1
-                    if len(s) > widths[i]:
-                        widths[i] = len(s)
-                row.append(s)
-            table.append(row)
-            ids.append(dct.id)
+                    s = fmts[i] % s
+            append(s)
+        return row
+
+    def format_row(self, dct):
+        """
+        Format the cells of a single row and add them to the table
+        """
+        self.table.append(self.cells(dct))
+        self.ids.append(dct.id)
+
+    def end(self):
+        """
+        Sort and print the table. Returns list of ids and of non-empty columns.
+        """
+        opts = self.opts
+        table = self.table
+        signs = self.signs
+        columns = table[0]
+        ids = self.ids
+        fd = sys.stdout
+
+        if len(ids) == 0:
+            return (ids, [])
 
         if self.sort:
-            headline = table.pop(0)
             n = self.columns.index(self.sort)
-            table.sort(key=lambda row: row[n])
-            table.insert(0, headline)
+            table = [table[0]] + sorted(table[1:], key=itemgetter(n))
 
         if opts.uniq:
-            uniq_table = [table.pop(0)] # header rows
-            first_row = table.pop(0)
-            count = 1
-            for row in table:
-                if row == first_row:
-                    count += 1
-                else:
-                    uniq_table.append(first_row + [count])
-                    widths[-1] = max(widths[-1], len(str(count)))
-                    first_row = row
-                    count = 1
-
-            uniq_table.append(first_row + [count])
-            widths[-1] = max(widths[-1], len(str(count)))
-
-            table = uniq_table
-
+            # count repeats of each distinct row anywhere in the table,
+            # not just adjacent ones, keeping first-seen order
+            counts = OrderedDict()
+            for row in table[1:]:
+                key = tuple(row)
+                counts[key] = counts.get(key, 0) + 1
+            table = [table[0]] + [list(key) + [str(count)]
+                                  for key, count in counts.items()]
+
+        # width of each column is that of its longest cell
+        widths = [max(map(len, cells)) for cells in zip(*table[1:])]
         widths = [w and max(w, len(col))
                   for w, col in zip(widths, columns)]
 
         columns = [ col for w, col in zip(widths, table[0]) if w > 0]
 
         if not opts.list_columns:
+            # bound printf-style format for each column which is kept in the
+            # output; unlike str.format, this promotes to unicode on Python 2
+            kept = [(('%%%ds' % (w * sign)).__mod__, i)
+                    for i, (w, sign) in enumerate(zip(widths, signs)) if w > 0]
+            out_lines = []
             for row in table:
-                line = '|'.join('%*s' % (w * sign, s)
-                                  for w, sign, s in zip(widths, signs, row)
-                                  if w > 0)
+                line = '|'.join([fmt(row[i]) for fmt, i in kept])
                 if opts.wiki_table:
                     line = '|' + line + '|'
-                fd.write(line)
-                fd.write('\n')
+                out_lines.append(line)
+                if len(out_lines) >= 1000:
+                    fd.write('\n'.join(out_lines) + '\n')
+                    out_lines = []
+            if out_lines:
+                fd.write('\n'.join(out_lines) + '\n')
+            fd.flush()
         return (ids, columns)
+
     
 
 def run(opts, args, verbosity):
     args = args[:]
     con = connect(args.pop(0))
+    clear_caches()
     if args:
         if len(args) == 1 and args[0].isdigit():
             expressions = int(args[0])
@@ -243,52 +448,95 @@ def run(opts, args, verbosity):
     else:
         expressions = []
 
-    if opts.count or opts.uniq:
-        opts.limit = 0
-
-    rows = con.select(expressions, verbosity=verbosity, limit=opts.limit)
-
     if opts.count:
-        n = 0
-        for row in rows:
-            n += 1
+        # let the database backend do the counting if it can
+        if hasattr(con, 'count'):
+            n = con.count(expressions)
+        else:
+            n = sum(1 for row in con.select(expressions, verbosity=verbosity,
+                                            limit=0, **select_columns(con, [])))
         print('%s' % plural(n, 'row'))
         return
 
-    dcts = list(rows)
-
-    if len(dcts) > 0:
-        if opts.include_all or opts.list_columns:
-            keys = []
-            for dct in dcts:
-                if hasattr(dct, 'key_value_pairs'):
-                    for key in dct.key_value_pairs.keys():
-                        if key not in keys:
-                            keys.append(key)
-            opts.columns = ','.join(['+'+key for key in keys])
-
-        f = Formatter(opts.columns, opts.sort)
-        if verbosity >= 1:
-            ids, columns = f.format(dcts, opts)
-        if verbosity > 1 or opts.list_columns:
-            for col in columns:
-                if not opts.list_columns:
-                    print 'COLUMN',
-                print col
-            if opts.list_columns:
-                return
-
-        if opts.extract is not None:
-            if '%' not in opts.extract:
+    tsv = opts.tsv
+
+    if opts.uniq:
+        opts.limit = 0
+
+    if opts.include_all or opts.list_columns:
+        # extra pass over the selection to find all key/value pairs
+        keys = []
+        for dct in con.select(expressions, verbosity=verbosity, limit=opts.limit,
+                              **select_columns(con, ['key_value_pairs'])):
+            if hasattr(dct, 'key_value_pairs'):
+                for key in dct.key_value_pairs.keys():
+                    if key not in keys:
+                        keys.append(key)
+        opts.columns = ','.join(['+'+key for key in keys])
+
+    f = Formatter(opts.columns, opts.sort)
+    extract = opts.extract is not None and not opts.list_columns
+    if extract:
+        select_kwargs = {}
+    else:
+        # only read the parts of each row needed for the table
+        select_kwargs = select_columns(con, f.reads)
+    # with --tsv, stdout holds only the data; the database backend would
+    # print its queries there when verbose, and other messages go to stderr
+    if tsv:
+        select_verbosity = min(verbosity, 1)
+        info = sys.stderr
+    else:
+        select_verbosity = verbosity
+        info = sys.stdout
+    rows = con.select(expressions, verbosity=select_verbosity, limit=opts.limit,
+                      **select_kwargs)
+
+    # rows are streamed: each one is added to the table and extracted
+    # in turn, so only the formatted table is held in memory
+    format_table = verbosity >= 1
+    if format_table:
+        f.begin(opts)
+        if tsv:
+            # rows are written as soon as they are formatted, with no table.
+            # The header is written with the first row, so an empty
+            # selection gives no output, as for the table.
+            fd = sys.stdout
+    if extract:
+        # either one writer per config, or a single writer opened once
+        # and kept for all configs
+        multiple_files = '%' in opts.extract
+        verbose_extract = verbosity > 1
+    writer = None
+    for i, dct in enumerate(rows):
+        if format_table:
+            if tsv:
+                if i == 0:
+                    fd.write(tsv_line(f.columns))
+                fd.write(tsv_line(f.cells(dct)))
+            else:
+                f.format_row(dct)
+        if extract:
+            if multiple_files:
+                filename = opts.extract % i
+                writer = AtomsWriter(filename)
+            elif writer is None:
                 writer = AtomsWriter(opts.extract)
-            for i, dct in enumerate(dcts):
-                if '%' in opts.extract:
-                    filename = opts.extract % i
-                    writer = AtomsWriter(filename)
-                at = dict2atoms(dct)
-                if verbosity > 1:
-                    print 'Writing config %d %r to %r' % (i, at, writer)
-                writer.write(at)
+            at = dict2atoms(dct)
+            if verbose_extract:
+                info.write('Writing config %d %r to %r\n' % (i, at, writer))
+            writer.write(at)
+
+    if format_table:
+        if tsv:
+            columns = f.columns
+        else:
+            ids, columns = f.end()
+    if verbosity > 1 or opts.list_columns:
+        for col in columns:
+            if not opts.list_columns:
+                info.write('COLUMN ')
+            print(col, file=info)
 
 examples = [
     'List all columns in database, one per line, then exit',
@@ -309,6 +557,9 @@ examples = [
     'Table of specific columns for rows matching expression',
     '  db-dump.py Si_GAP.db config_type=bt -c id,formula,calc,dft_energy,config_type',
     '',
+    'Specific columns as tab-separated values, written as each row is read',
+    '  db-dump.py Si_GAP.db -c id,formula,dft_energy,config_type --tsv --limit=0',
+    '',
     'Specific columns, in sorted order. Duplicate rows suppressed with -u/--uniq',
     '  db-dump.py Si_GAP.db -c user,formula,calc,config_type -s config_type -u',
     '',
@@ -349,11 +600,14 @@ add('-a', '--include-all', action='store_true', default=False,
 add('-s', '--sort', metavar='column',
     help='Sort rows using column.  Default is to sort after ID.')
 add('-u', '--uniq', action='store_true',
-    help='Suppress printing of duplicate rows. Implies --limit=0.')
+    help='Suppress printing of duplicate rows, whether or not they are ' +
+    'adjacent, adding a "repeat" column with the number of copies of each ' +
+    'row. Implies --limit=0.')
 add('-x', '--extract', metavar='filename',
     help='''Extract matching configs and save to file(s). Use a filename containing a
 "%" expression for multiple files labelled by an index starting from 0,
-e.g. "file-%03d.xyz".''')
+e.g. "file-%03d.xyz". Configs are written as the rows are read, so the table
+is printed once all of them have been written.''')
 add('--limit', type=int, default=500, metavar='N',
     help='Show only first N rows (default is 500 rows).  Use --limit=0 ' +
     'to show all.')
@@ -361,15 +615,23 @@ add('-w', '--wiki-table', action='store_true',
     help='Format output as a Wiki table')
 add('--cut', action='store', type=int, default=30,
     help='Truncate columns after CUT characters. Default 30. Use 0 for no limit')
+add('--tsv', action='store_true', default=False,
+    help='''Output tab-separated values rather than an aligned table. Rows are
+written as they are read, after a header row which is omitted if no rows are
+selected. Backslashes, tabs and newlines within values are written as \\\\,
+\\t, \\n and \\r, and text is encoded as UTF-8. Verbose messages go to stderr.
+Cannot be combined with --sort, --uniq, --wiki-table or --list-columns.''')
 
 opts, args = parser.parse_args()
+if opts.tsv and (opts.sort or opts.uniq or opts.wiki_table or opts.list_columns):
+    parser.error('--tsv cannot be combined with --sort, --uniq, --wiki-table or --list-columns')
 verbosity = 1 - opts.quiet + opts.verbose
 
 try: 
     run(opts, args, verbosity)
 except Exception as x:
     if verbosity < 2:
-        print('{0}: {1}'.format(x.__class__.__name__, x.message))
+        print('{0}: {1}'.format(x.__class__.__name__, str(x)))
         sys.exit(1)
     else:
         raise